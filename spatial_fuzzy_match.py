@@ -11,7 +11,10 @@
 #              Input data is not case-sensitive. All records are lower-cased at the time of comparison
 #              Records with Null geometry are still considered; they are just mapped to (0,0)
 #
-#              FuzzyWuzzy Levenshtein distance metrics:
+#              All rows are loaded once and neighbours are found with an in-memory R-tree spatial index,
+#              or for smaller tables a NumPy scan of all the coords, or optionally a grid of search distance cells
+#
+#              RapidFuzz Levenshtein distance metrics (same as FuzzyWuzzy, hence the fw_ prefix):
 #
 #                  fw_ratio
 #                  fw_partial_ratio
@@ -20,7 +23,9 @@
 #
 #              After running this, configure and execute create_lines_from_match_results.py
 #
-#              Example run times against the Australian Tourism Datawarehouse:
+#              Example run times of version 1 against the Australian Tourism Datawarehouse. Version 1 ran
+#              MakeFeatureLayer, SelectLayerByAttribute, SelectLayerByLocation, GetCount and a nested SearchCursor
+#              for every row. Version 2 reads the FC with a single SearchCursor and runs no geoprocessing per row:
 #
 #              All ATDW data
 #              input rows            1,4683
@@ -33,7 +38,7 @@
 ##
 #
 #
-# version      1
+# version      2
 # author       Mic Zatorsky
 # created      11/09/2020
 #
@@ -42,14 +47,17 @@
 # param:       left_fc_text_field  Field containing text to compare
 # param:       left_fc_pk          The PK in the left FC
 # param:       search_distance     the distance that defines the neighborhood search
-# param:       report_folder       the folder to write the output CSV to
-# param:       report_name         the name of the CSV file with the pairs of close matches
+# param:       similarity_cutoff   the minimum score (0-100) a pair needs on at least one metric to be reported
+# param:       report_folder       the folder to write the report to
+# param:       report_name         the name of the report file with the pairs of close matches,
+#                                  .parquet writes a Parquet file, .csv writes a CSV
 #
 # pre:         the input FC exists
 #
 # return:      none
 #
-# post:        a CSV is written with the following structure
+# post:        a Parquet file or CSV is written with the pairs that reach the similarity cutoff,
+#              with the following structure
 #                  left_text
 #                  right_text
 #                  left_class
@@ -71,8 +79,12 @@
 #
 # Issues and known limitations:
 #     see all preconditions
-#     Written for Python 3.6
+#     Written for Python 3.9 or later, as shipped with ArcGIS Pro 3
 #     this version works with just one input FC, comparing it with itself
+#     requires the rtree, rapidfuzz (3.6 or later) and pyarrow packages (pip install rtree rapidfuzz pyarrow),
+#     rapidfuzz 3.6 is needed for process.cpdist and doesn't install on Python older than 3.8
+#     the search distance must be in the units of the FC's coordinate system, so the FC must use a projected CRS
+#     rows are compared in worker processes, debug messages logged by the workers may not reach the log file
 #
 # Dev Notes:
 #
@@ -87,15 +99,24 @@
 # Ref:
 #     https://www.datacamp.com/community/tutorials/fuzzy-string-python
 #     https://towardsdatascience.com/fuzzywuzzy-how-to-measure-string-distance-on-python-4e8852d7c18f
+#     https://maxbachmann.github.io/RapidFuzz/
 #
 # ---------------------------------------------------------------------------------------------------------------------
 
-import arcpy
+import collections
+import concurrent.futures
+import contextlib
+import csv
 import logging
 import os
+import re
 import datetime
-import uuid
-from fuzzywuzzy import fuzz
+import itertools
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from rapidfuzz import fuzz, process, utils
+from rtree import index
 
 start_time = datetime.datetime.now()
 log = logging.getLogger()
@@ -113,9 +134,29 @@ left_fc_pk = "Listing_Number"
 left_fc_text_field = "tmp_Feature_name"
 left_fc_class_field = "tmp_Main_Class"
 report_folder = r"C:\Users\mic.zatorsky\Data_Deduplication"
-report_filename = "ATDW_fuzzy_comparisons.csv"
+report_filename = "ATDW_fuzzy_comparisons.parquet"  # or .csv
 search_distance = "3600 Meters"
+similarity_cutoff = 70           # scores below this are reported as 0, pairs with all scores 0 are not written
 max_rows_to_process = 1000000    # reduce for testing
+parquet_row_group_size = 100000  # matches are buffered and written to the Parquet file in groups of this many
+rtree_min_rows = 50000           # with fewer rows than this, a NumPy scan finds neighbours faster than the R-tree
+use_grid = False                 # find neighbours with a grid instead, faster for dense data such as city listings
+
+# a row of the report, the fields are the columns in order
+Match = collections.namedtuple("Match", ["left_text", "right_text", "left_class", "right_class",
+                                         "fw_ratio", "fw_partial_ratio", "fw_token_sort_ratio", "fw_token_set_ratio",
+                                         "surrogate_key", "left_objectID", "right_objectID", "left_pk", "right_pk",
+                                         "left_x", "left_y", "right_x", "right_y"])
+
+# the types of the Match fields in the Parquet file
+report_schema = pa.schema([("left_text", pa.string()), ("right_text", pa.string()),
+                           ("left_class", pa.string()), ("right_class", pa.string()),
+                           ("fw_ratio", pa.uint8()), ("fw_partial_ratio", pa.uint8()),
+                           ("fw_token_sort_ratio", pa.uint8()), ("fw_token_set_ratio", pa.uint8()),
+                           ("surrogate_key", pa.int64()), ("left_objectID", pa.int32()),
+                           ("right_objectID", pa.int32()), ("left_pk", pa.string()), ("right_pk", pa.string()),
+                           ("left_x", pa.float64()), ("left_y", pa.float64()),
+                           ("right_x", pa.float64()), ("right_y", pa.float64())])
 
 
 # -----------------------------------------
@@ -124,7 +165,7 @@ max_rows_to_process = 1000000    # reduce for testing
 def setup_logger(log_folder):
     logfile_ext = ".log.csv"
     logfile = os.path.join(log_folder, program_name + logfile_ext)
-    log.setLevel(logging.DEBUG)  # or INFO
+    log.setLevel(logging.INFO)  # or DEBUG, which logs every row and slows down large runs
 
     # formatter for use by all handlers
     d = ","  # log column delimiter
@@ -159,58 +200,228 @@ def setup_logger(log_folder):
 # strip non ascii
 # -----------------------------------------
 def strip_non_ascii(string):
-    """ Returns the string without non ASCII characters"""
-    stripped = (c for c in string if 0 < ord(c) < 127)
-    return ''.join(stripped)
-
-
-# ------------------------------------------
-#  write list to CSV
-# -------------------------------------------
-
-def write_list_to_csv(the_list, the_csv_file_path):
-    log.info("Checking if the report file already exists [" + the_csv_file_path + "]")
-    if os.path.exists(the_csv_file_path):
-        log.info('Deleting existing file')
-        try:
-            os.remove(the_csv_file_path)
-        except Exception as e:
-            log.info("Failed to delete the file")
-            log.info(repr(e))
-            validation_fail = True
-
-    log.info('Creating the CSV file [' + the_csv_file_path + "]")
-    with open(the_csv_file_path, "w") as f:
-        log.info('Writing the file header')
-        header_row = "left_text,right_text,left_class,right_class," \
-                     "fw_ratio,fw_partial_ratio,fw_token_sort_ratio,fw_token_set_ratio," \
-                     "surrogate_key,left_objectID,right_objectID,left_pk,right_pk,left_x,left_y,right_x,right_y\n"
-        f.write(header_row)
-        for element in the_list:
-            surrogate_key = element.get("surrogate_key")
-            left_objectID = element.get("left_objectID")
-            right_objectID = element.get("right_objectID")
-            left_text = element.get("left_text")
-            right_text = element.get("right_text")
-            left_class = element.get("left_class")
-            right_class = element.get("right_class")
-            left_x = element.get("left_x")
-            left_y = element.get("left_y")
-            right_x = element.get("right_x")
-            right_y = element.get("right_y")
-            left_pk = element.get("left_pk")
-            right_pk = element.get("right_pk")
-            fw_ratio = element.get("fw_ratio")
-            fw_partial_ratio = element.get("fw_partial_ratio")
-            fw_token_sort_ratio = element.get("fw_token_sort_ratio")
-            fw_token_set_ratio = element.get("fw_token_set_ratio")
-
-            record = f'"{left_text}","{right_text}","{left_class}","{right_class}",' \
-                     f'{fw_ratio},{fw_partial_ratio},{fw_token_sort_ratio},{fw_token_set_ratio},' \
-                     f'{surrogate_key},{left_objectID},{right_objectID},"{left_pk}","{right_pk}",' \
-                     f'{left_x},{left_y},{right_x},{right_y}'
-            # log.debug("Writing row = [" + record + "]")
-            f.write(record + "\n")
+    """ Returns the string without non ASCII characters, NUL and DEL are also removed"""
+    # the codec drops the non ASCII characters in C, rather than testing each character in Python
+    return string.encode('ascii', 'ignore').decode('ascii').replace('\x00', '').replace('\x7f', '')
+
+
+# -----------------------------------------
+# parse the search distance
+# -----------------------------------------
+def parse_search_distance(distance):
+    """ Returns the number and unit of a linear distance, e.g. "3600 Meters" -> (3600.0, "Meters")
+
+    The number must be greater than 0"""
+    m = re.match(r'\s*(\d+(?:\.\d+)?)\s*(\w+)\s*$', distance)
+    if m is None:
+        raise ValueError("The search distance [" + distance + "] is not a number followed by a unit")
+    number = float(m.group(1))
+    if number <= 0:
+        raise ValueError("The search distance [" + distance + "] must be greater than 0")
+    return number, m.group(2)
+
+
+# -----------------------------------------
+# score a batch of pairs
+# -----------------------------------------
+# RapidFuzz applies score_cutoff to the float score before it is rounded, so the cutoff is lowered by half a point
+# to keep the scores that round up to the similarity cutoff, e.g. 69.6 is reported as 70
+rounded_score_cutoff = similarity_cutoff - 0.5
+
+
+def score_batch(query, choices, scorer):
+    """ Returns the scores of the query against each of the choices as a uint8 NumPy array
+
+    The texts must already be pre-processed. RapidFuzz returns floats, these are rounded to whole numbers to keep
+    the results comparable with FuzzyWuzzy. Scores below the similarity cutoff are returned as 0"""
+    if not choices:
+        return np.zeros(0, dtype=np.uint8)
+    return process.cdist([query], choices, scorer=scorer, processor=None, score_cutoff=rounded_score_cutoff,
+                         dtype=np.uint8, workers=1)[0]  # the rows are already spread over a process pool
+
+
+def score_pairs(queries, choices, scorer):
+    """ Returns the score of each query against the choice at the same position as a uint8 NumPy array
+
+    As score_batch(), but pairwise, so several metrics that use the same scorer can be calculated in one call"""
+    if not choices:
+        return np.zeros(0, dtype=np.uint8)
+    return process.cpdist(queries, choices, scorer=scorer, processor=None, score_cutoff=rounded_score_cutoff,
+                          dtype=np.uint8, workers=1)
+
+
+# -----------------------------------------
+# length filter for the ratio metric
+# -----------------------------------------
+def ratio_possible(left_length, right_lengths):
+    """ Returns a boolean array, True where the ratio can still reach the similarity cutoff given the text lengths
+
+    ratio = 100 * (1 - distance / total length) and the distance is at least the difference in length, so when
+    the lengths differ by too much the ratio is below the cutoff without having to calculate it. Like the scorers,
+    this uses the cutoff before rounding, so pairs whose ratio rounds up to the cutoff are kept"""
+    total_lengths = left_length + right_lengths
+    return np.abs(right_lengths - left_length) * 100 <= total_lengths * (100 - rounded_score_cutoff)
+
+
+# -----------------------------------------
+# convert matches for the Parquet file
+# -----------------------------------------
+def matches_to_table(matches):
+    """ Returns a list of Match as a pyarrow Table with the report schema
+
+    The PKs are written as strings, whatever their type in the FC"""
+    arrays = []
+    for column, field in zip(zip(*matches), report_schema):
+        if pa.types.is_string(field.type):
+            column = [None if value is None else str(value) for value in column]
+        arrays.append(pa.array(column, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=report_schema)
+
+
+# -----------------------------------------
+# worker process set up
+# -----------------------------------------
+# each worker process gets its own copy of the loaded columns and builds its own spatial index,
+# these are module level so process_left() can be passed to the pool by name
+worker_data = {}
+
+
+def init_worker(columns):
+    """ Stores the loaded columns in the worker process and builds the spatial index over them
+
+    columns is a dict of equal length columns, NumPy arrays for the OIDs and coords and lists for the strings,
+    plus the search distance d and its square d2. With use_grid a grid is always built. Otherwise the R-tree is
+    built when there are at least rtree_min_rows rows, and neither is built for fewer rows"""
+    idx = None
+    grid = None
+    if use_grid:
+        # square cells the size of the search distance, so a point's neighbours are all in the 3 x 3 cells around it
+        cells = collections.defaultdict(list)
+        cell_xs = np.floor(columns["xs"] / columns["d"]).astype(np.int64)
+        cell_ys = np.floor(columns["ys"] / columns["d"]).astype(np.int64)
+        for i, cell in enumerate(zip(cell_xs.tolist(), cell_ys.tolist())):
+            cells[cell].append(i)
+        grid = {cell: np.array(members, dtype=np.int64) for cell, members in cells.items()}
+    elif len(columns["oids"]) >= rtree_min_rows:
+        # bulk loading from a stream packs the tree, which is quicker to build and to query than inserting each point
+        points = ((i, (x, y, x, y), None) for i, (x, y) in enumerate(zip(columns["xs"], columns["ys"])))
+        idx = index.Index(points)
+    worker_data.update(columns, idx=idx, grid=grid)
+
+
+# -----------------------------------------
+# compare one left row with its neighbours
+# -----------------------------------------
+def process_left(i):
+    """ Returns (matches, comparison_count, skipped_comparison_count) for the i-th loaded row
+
+    Only neighbours with a higher OBJECTID are compared. The metrics are symmetric, so this compares each pair
+    exactly once across all rows without having to remember which pairs have been done"""
+    oids = worker_data["oids"]
+    xs = worker_data["xs"]
+    ys = worker_data["ys"]
+    pks = worker_data["pks"]
+    texts = worker_data["texts"]
+    classes = worker_data["classes"]
+    lowers = worker_data["lowers"]
+    processed = worker_data["processed"]
+    sorted_tokens = worker_data["sorted_tokens"]
+    lower_lengths = worker_data["lower_lengths"]
+    sorted_token_lengths = worker_data["sorted_token_lengths"]
+    d = worker_data["d"]
+    d2 = worker_data["d2"]
+    idx = worker_data["idx"]
+    grid = worker_data["grid"]
+
+    matches = []
+
+    left_objectID = int(oids[i])
+    left_text = texts[i]
+    left_x = xs[i]
+    left_y = ys[i]
+    left_pk = pks[i]
+    left_class = classes[i]
+
+    # the messages are only built when debug is on, as this runs for every row
+    debug = log.isEnabledFor(logging.DEBUG)
+    if debug:
+        log.debug("fc LEFT cursor read id:{} text:{} x:{} y:{} pk:{} class:{}".format(left_objectID, left_text,
+                                                                                      left_x, left_y, left_pk,
+                                                                                      left_class))
+        log.debug("Searching " + search_distance + " around OBJECTID [" + str(left_objectID) + "] " + left_text)
+
+    # distances are compared squared, which avoids a square root per candidate
+    x0, y0 = left_x, left_y
+    if grid is not None:
+        # candidates from the grid are in the 3 x 3 cells around this one, keep those within the search distance
+        cell_x = int(np.floor(x0 / d))
+        cell_y = int(np.floor(y0 / d))
+        no_cell = np.zeros(0, dtype=np.int64)
+        candidates = np.concatenate([grid.get((cell_x + offset_x, cell_y + offset_y), no_cell)
+                                     for offset_x in (-1, 0, 1) for offset_y in (-1, 0, 1)])
+        dx = xs[candidates] - x0
+        dy = ys[candidates] - y0
+        candidates = candidates[dx * dx + dy * dy <= d2]
+    elif idx is not None:
+        # candidates from the index are within the bounding box, keep those within the search distance
+        candidates = np.fromiter(idx.intersection((x0 - d, y0 - d, x0 + d, y0 + d)), dtype=np.int64)
+        dx = xs[candidates] - x0
+        dy = ys[candidates] - y0
+        candidates = candidates[dx * dx + dy * dy <= d2]
+    else:
+        # few enough rows to check the distance to all of them in one pass
+        dx = xs - x0
+        dy = ys - y0
+        candidates = np.nonzero(dx * dx + dy * dy <= d2)[0]
+    if debug:
+        log.debug("{} records within search distance, comparing".format(len(candidates)))
+
+    # work out which pairs still need comparing, a pair is compared when processing its lower OBJECTID
+    # equal OBJECTIDs are the record itself, which is never compared
+    candidate_oids = oids[candidates]
+    to_compare = candidates[candidate_oids > left_objectID]
+    skipped_comparison_count = int(np.count_nonzero(candidate_oids < left_objectID))
+
+    # calculate fuzzy similarity metrics for all the pairs
+    # fw_ratio and fw_token_sort_ratio both use the ratio scorer, so they are calculated together in one call,
+    # skipping the pairs whose lengths differ too much to reach the cutoff, these score 0
+    # the other metrics can match on part of a text, so the length filter doesn't apply to them
+    ratio_mask = ratio_possible(lower_lengths[i], lower_lengths[to_compare])
+    token_sort_mask = ratio_possible(sorted_token_lengths[i], sorted_token_lengths[to_compare])
+    ratio_js = to_compare[ratio_mask]
+    token_sort_js = to_compare[token_sort_mask]
+    ratio_pairs = score_pairs([lowers[i]] * len(ratio_js) + [sorted_tokens[i]] * len(token_sort_js),
+                              [lowers[j] for j in ratio_js] + [sorted_tokens[j] for j in token_sort_js], fuzz.ratio)
+    ratios = np.zeros(len(to_compare), dtype=np.uint8)
+    ratios[ratio_mask] = ratio_pairs[:len(ratio_js)]
+    token_sort_ratios = np.zeros(len(to_compare), dtype=np.uint8)
+    token_sort_ratios[token_sort_mask] = ratio_pairs[len(ratio_js):]
+    partial_ratios = score_batch(lowers[i], [lowers[j] for j in to_compare], fuzz.partial_ratio)
+    token_set_ratios = score_batch(processed[i], [processed[j] for j in to_compare], fuzz.token_set_ratio)
+
+    for k, j in enumerate(to_compare):
+        fw_ratio = int(ratios[k])
+        fw_partial_ratio = int(partial_ratios[k])
+        fw_token_sort_ratio = int(token_sort_ratios[k])
+        fw_token_set_ratio = int(token_set_ratios[k])
+
+        if not (fw_ratio or fw_partial_ratio or fw_token_sort_ratio or fw_token_set_ratio):
+            continue  # below the similarity cutoff
+
+        right_objectID = int(oids[j])
+        right_text = texts[j]
+        right_x = xs[j]
+        right_y = ys[j]
+        right_pk = pks[j]
+        right_class = classes[j]
+
+        # the surrogate key is set when the match is written
+        matches.append(Match(left_text, right_text, left_class, right_class,
+                             fw_ratio, fw_partial_ratio, fw_token_sort_ratio, fw_token_set_ratio,
+                             None, left_objectID, right_objectID, left_pk, right_pk,
+                             left_x, left_y, right_x, right_y))
+
+    return matches, len(to_compare), skipped_comparison_count
 
 
 # -----------------------------------------
@@ -220,131 +431,114 @@ def write_list_to_csv(the_list, the_csv_file_path):
 def main():
     """main"""
 
+    # arcpy is only needed to read the FC, importing it here rather than at the top stops every worker process
+    # importing it as well, which takes seconds and a licence check per process
+    import arcpy
+
     log.info('Start')
 
     # init some vars
-    compared_set = set()  # the set of object IDs we have already compared, used to avoid doing things twice
-    comparison_list = []  # a list of all comparisons
+    matches_written_count = 0  # tracking how many comparisons reach the similarity cutoff
+    comparison_count = 0  # tracking how many pairs we calc similarity for
     skipped_comparison_count = 0  # tracking how often we don't have to calc similarity
 
     # lets get into it
     left_fc = left_fc_gdb + "\\" + left_fc_name
-    arcpy.MakeFeatureLayer_management(left_fc, "left_fc_lyr")
-    input_rows_count = int(arcpy.GetCount_management("left_fc_lyr")[0])
-    log.info("{} input rows to process".format(input_rows_count))
     fields = ["OBJECTID", left_fc_text_field, "SHAPE@X", "SHAPE@Y", left_fc_pk, left_fc_class_field]
-    current_row = 0
-    with arcpy.da.SearchCursor("left_fc_lyr", fields) as fc_cursor:
-        for fc_cursor_row in fc_cursor:
-            left_objectID = fc_cursor_row[0]
-            left_text = strip_non_ascii(fc_cursor_row[1])
-            left_x = fc_cursor_row[2]
-            left_y = fc_cursor_row[3]
-            left_pk = fc_cursor_row[4]
-            left_class = strip_non_ascii(fc_cursor_row[5])
-            log.debug("fc LEFT cursor read id:{} text:{} x:{} y:{} pk:{} class:{}".format(left_objectID, left_text,
-                                                                                          left_x, left_y, left_pk,
-                                                                                          left_class))
-
-            # fix issue with missing coords (NULLS in the original data)
-            if left_x is not None:
-                left_x = str(round(fc_cursor_row[2], 8))
-            else:
-                left_x = str(0)
-
-            if left_y is not None:
-                left_y = str(round(fc_cursor_row[3], 8))
-            else:
-                left_y = str(0)
-
-            log.debug("Searching " + search_distance + " around OBJECTID [" + str(left_objectID) + "] " + left_text)
-
-            # select this record
-            arcpy.SelectLayerByAttribute_management(in_layer_or_view="left_fc_lyr",
-                                                    selection_type="NEW_SELECTION",
-                                                    where_clause="OBJECTID = {}".format(left_objectID))
-
-            # select nearby records within the search distance
-            arcpy.SelectLayerByLocation_management(in_layer="left_fc_lyr",
-                                                   overlap_type="WITHIN_A_DISTANCE",
-                                                   select_features="left_fc_lyr",
-                                                   search_distance=search_distance,
-                                                   selection_type="NEW_SELECTION",
-                                                   invert_spatial_relationship="NOT_INVERT")
-
-            row_count = int(arcpy.GetCount_management("left_fc_lyr")[0])
-            log.debug("{} records within search distance, comparing".format(row_count))
-
-            with arcpy.da.SearchCursor("left_fc_lyr", fields) as sel_cursor:
-                for sel_cursor_row in sel_cursor:
-                    surrogate_key = str(uuid.uuid4())  # generate a GUID for this row
-                    right_objectID = sel_cursor_row[0]
-                    right_text = strip_non_ascii(sel_cursor_row[1])
-                    right_x = str(round(sel_cursor_row[2], 8))
-                    right_y = str(round(sel_cursor_row[3], 8))
-                    right_pk = sel_cursor_row[4]
-                    right_class = strip_non_ascii(sel_cursor_row[5])
-                    log.debug(
-                        "sel RIGHT cursor read id:{} text:{} x:{} y:{} pk:{} class:{}".format(right_objectID, right_text,
-                                                                                              right_x, right_y, right_pk,
-                                                                                              right_class))
-
-                    if left_objectID != right_objectID:  # don't compare a record with itself
-                        this_pair = str(left_objectID) + "," + str(right_objectID)
-                        inverse_of_this_pair = str(right_objectID) + "," + str(left_objectID)
-                        if this_pair not in compared_set:
-
-                            # calculate fuzzy similarity metrics
-
-                            fw_ratio = fuzz.ratio(left_text.lower(), right_text.lower())
-                            fw_partial_ratio = fuzz.partial_ratio(left_text.lower(), right_text.lower())
-                            fw_token_sort_ratio = fuzz.token_sort_ratio(left_text.lower(), right_text.lower())
-                            fw_token_set_ratio = fuzz.token_set_ratio(left_text.lower(), right_text.lower())
-
-                            this_match_dict = {}
-                            this_match_dict.update({"surrogate_key": surrogate_key})
-                            this_match_dict.update({"left_objectID": left_objectID})
-                            this_match_dict.update({"right_objectID": right_objectID})
-                            this_match_dict.update({"left_text": left_text})
-                            this_match_dict.update({"right_text": right_text})
-                            this_match_dict.update({"left_class": left_class})
-                            this_match_dict.update({"right_class": right_class})
-                            this_match_dict.update({"left_x": left_x})
-                            this_match_dict.update({"left_y": left_y})
-                            this_match_dict.update({"right_x": right_x})
-                            this_match_dict.update({"right_y": right_y})
-                            this_match_dict.update({"left_pk": left_pk})
-                            this_match_dict.update({"right_pk": right_pk})
-                            this_match_dict.update({"fw_ratio": fw_ratio})
-                            this_match_dict.update({"fw_partial_ratio": fw_partial_ratio})
-                            this_match_dict.update({"fw_token_sort_ratio": fw_token_sort_ratio})
-                            this_match_dict.update({"fw_token_set_ratio": fw_token_set_ratio})
-
-                            log.debug("Appending pair to the comparison list")
-                            comparison_list.append(this_match_dict)
-
-                            compared_set.add(this_pair)
-                            compared_set.add(inverse_of_this_pair)
-
-                        else:
-                            log.debug("skipping comparison")
-                            skipped_comparison_count = skipped_comparison_count + 1
-
-            # progress indicator
-            current_row = current_row + 1
-            percent_complete = (current_row / input_rows_count) * 100
-            log.info("{number: .{precision}f} % complete".format(number=percent_complete, precision=3))
-
-            # stop after the first few
-            if current_row >= max_rows_to_process:
-                break
+
+    # the search distance is compared with the coords, so it must be in the units of the FC's CRS
+    d, unit = parse_search_distance(search_distance)
+    crs_unit = arcpy.Describe(left_fc).spatialReference.linearUnitName  # e.g. "Meter", blank when geographic
+    if unit.lower().rstrip("s") != crs_unit.lower().rstrip("s"):
+        log.error("The search distance unit [" + unit + "] doesn't match the FC's coordinate system unit [" +
+                  crs_unit + "]. Program stopping")
+        raise ValueError("search distance unit " + unit + " doesn't match the FC's unit " + crs_unit)
+
+    # load every row once in a single pass, into one column per field rather than a tuple per row
+    log.info("Loading rows from " + left_fc)
+    oids, raw_texts, xs, ys, pks, raw_classes = [], [], [], [], [], []
+    with arcpy.da.SearchCursor(left_fc, fields) as fc_cursor:
+        for oid, text, x, y, pk, class_ in fc_cursor:
+            oids.append(oid)
+            raw_texts.append(text)
+            xs.append(x)
+            ys.append(y)
+            pks.append(pk)
+            raw_classes.append(class_)
+    oids = np.array(oids, dtype=np.int64)
+    xs = np.array(xs, dtype=np.float64)  # NULL coords become NaN, then are mapped to (0,0)
+    ys = np.array(ys, dtype=np.float64)
+    xs = np.where(np.isnan(xs), 0.0, xs)
+    ys = np.where(np.isnan(ys), 0.0, ys)
+    input_rows_count = len(oids)
+    log.info("{} input rows to process".format(input_rows_count))
+
+    # clean and lower-case each text once, rather than for every pair it is compared in
+    texts = [strip_non_ascii(text) for text in raw_texts]
+    classes = [strip_non_ascii(class_) for class_ in raw_classes]
+    lowers = [text.lower() for text in texts]
+    processed = [utils.default_process(text) for text in texts]  # as FuzzyWuzzy's token metrics pre-process
+
+    # token_sort_ratio is the ratio of the texts with their words sorted, so sort each text's words once here
+    # token_set_ratio can't be done the same way, as it depends on the words the two texts have in common
+    sorted_tokens = [" ".join(sorted(text.split())) for text in processed]
+    lower_lengths = np.array([len(text) for text in lowers], dtype=np.int32)
+    sorted_token_lengths = np.array([len(text) for text in sorted_tokens], dtype=np.int32)
+
+    # the columns shared with the worker processes
+    columns = {"oids": oids, "xs": xs, "ys": ys, "pks": pks, "texts": texts, "classes": classes,
+               "lowers": lowers, "processed": processed, "sorted_tokens": sorted_tokens,
+               "lower_lengths": lower_lengths, "sorted_token_lengths": sorted_token_lengths, "d": d,
+               "d2": d * d}
 
     # ---------------------------------
-    # write the results to CSV
+    # compare and write the results to the report
     # --------------------------------
+    # matches are written as they are found, rather than held in memory until the end
 
     report_filepath = os.path.join(report_folder, report_filename)
-    write_list_to_csv(comparison_list, report_filepath)
+    write_parquet = report_filepath.lower().endswith(".parquet")
+    log.info('Creating the report file [' + report_filepath + "]")
+    with contextlib.ExitStack() as stack:
+        if write_parquet:
+            # strings are dictionary encoded by the writer, so repeated texts and classes are stored once
+            parquet_writer = stack.enter_context(pq.ParquetWriter(report_filepath, report_schema))
+            row_group = []
+        else:
+            f = stack.enter_context(open(report_filepath, "w", newline="", buffering=1 << 20))
+            writer = csv.writer(f)
+            log.info('Writing the file header')
+            writer.writerow(Match._fields)
+
+        # the rows don't depend on each other, so compare them in parallel, one worker process per CPU
+        # Windows can't run more than 61 workers in a pool
+        rows_to_process = min(input_rows_count, max_rows_to_process)
+        worker_count = min(os.cpu_count(), 61)
+        log.info("Comparing rows using {} processes".format(worker_count))
+        current_row = 0
+        surrogate_keys = itertools.count(1)  # a sequence number for each row written
+        with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count, initializer=init_worker,
+                                                    initargs=(columns,)) as executor:
+            for matches, compared, skipped in executor.map(process_left, range(rows_to_process), chunksize=64):
+                matches = [match._replace(surrogate_key=next(surrogate_keys)) for match in matches]
+                if write_parquet:
+                    row_group.extend(matches)
+                    if len(row_group) >= parquet_row_group_size:
+                        parquet_writer.write_table(matches_to_table(row_group))
+                        row_group = []
+                else:
+                    writer.writerows(matches)
+                matches_written_count = matches_written_count + len(matches)
+                comparison_count = comparison_count + compared
+                skipped_comparison_count = skipped_comparison_count + skipped
+
+                # progress indicator
+                current_row = current_row + 1
+                percent_complete = (current_row / input_rows_count) * 100
+                log.info("{number: .{precision}f} % complete".format(number=percent_complete, precision=3))
+
+        if write_parquet and row_group:
+            parquet_writer.write_table(matches_to_table(row_group))
 
     # --------
     # wrap up
@@ -352,7 +546,9 @@ def main():
     log.info("Finished")
     log.info("input rows            {}".format(input_rows_count))
     log.info("search distance       {}".format(search_distance))
-    log.info("comparisons made      {}".format(len(comparison_list)))
+    log.info("similarity cutoff     {}".format(similarity_cutoff))
+    log.info("comparisons made      {}".format(comparison_count))
+    log.info("matches written       {}".format(matches_written_count))
     log.info("comparisons skipped   {}".format(skipped_comparison_count))
 
     end_time = datetime.datetime.now()